@@ -1,7 +1,17 @@
+import queue
 import re
 import threading
 import time
 
+from enum import IntEnum
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 from printrun.printcore import printcore
 from printrun.eventhandler import PrinterEventHandler
 
@@ -20,11 +30,37 @@ COM_PORT = 'COM8'
 TOLERANCE_MM = 0.035
 DEFAULT_DELTA_RADIUS = 61.7
 Z_OFFSET = .55
+AUTOLEVEL_RUNS = 3
+REPLY_TIMEOUT_S = 120
+
+# command acknowledgement, a plain literal so it's matched without the regex engine
+CMD_COMPLETE = 'ok N0 P15 B15'
+
+# any other advanced-ok ack; sent while commands are still in flight, so fewer buffer slots are free
+ACK_RE = re.compile(r'ok N\d+ P\d+ B\d+')
+
+# queue kinds that mark a command as acknowledged
+ACK_KINDS = ('ok', 'ack')
+
+# classifies every other received line in one pass; the outer named group gives the line kind and
+# the three groups following it carry the numeric payload
+LINE_RE = re.compile(
+    r'(?P<g29>Bed X: *(\S+) +Y: *(\S+) +Z: *(\S+))'
+    r'|(?P<m666>M666 X(\S+) Y(\S+) Z(\S+))'
+    r'|(?P<m665>M665 L(\S+) R(\S+) S(\S+))'
+)
 
-CMD_COMPLETE_REGEX = 'ok N0 P15 B15'
-G29_REGEX = 'Bed X\: (.*) Y\: (.*) Z\: (.*)'
-M666_REGEX = 'M666 X(.*) Y(.*) Z(.*)'
-M665_REGEX = 'M665 L(.*) R(.*) S(.*)'
+
+# slots of the per-axis statistics buffer
+class Stat(IntEnum):
+    Z_AVG = 0
+    X_AVG = 1
+    Y_AVG = 2
+    C_AVG = 3
+    Z_VAR = 4
+    X_VAR = 5
+    Y_VAR = 6
+    C_VAR = 7
 
 
 # ##################################################################################################
@@ -34,13 +70,69 @@ M665_REGEX = 'M665 L(.*) R(.*) S(.*)'
 # ####
 
 # --------------------------------------------------------------------------------------------------
-def debug(line):
+def debug(fmt, *args):
+    # formatting is deferred so that per-line calls cost nothing with DEBUG off. callers pass
+    # already stripped values
     if DEBUG:
-        print('[DEBUG] :: {0}'.format(line.strip()))
+        print(f'[DEBUG] :: {fmt.format(*args)}')
 
 # --------------------------------------------------------------------------------------------------
 def log(line):
-    print('[LOG] :: {0}'.format(line.strip()))
+    print(f'[LOG] :: {line}')
+
+# --------------------------------------------------------------------------------------------------
+def next_reply(handler):
+    # next queued (kind, payload), failing on printer errors or when the printer goes quiet
+    try:
+        kind, payload = handler.q.get(timeout=REPLY_TIMEOUT_S)
+    except queue.Empty:
+        raise Exception(f'no reply from printer in {REPLY_TIMEOUT_S}s')
+
+    if kind == 'err':
+        raise Exception(f'printer error :: {payload}')
+
+    return kind, payload
+
+# --------------------------------------------------------------------------------------------------
+def wait_ok(handler):
+    # every received line stays queued, so skip anything that isn't the command ack
+    while True:
+        kind, payload = next_reply(handler)
+        if kind in ACK_KINDS:
+            return
+
+
+# ##################################################################################################
+#
+# Variance kernels
+#
+# datapoints are a C-contiguous (runs, 8) float64 array with columns z1, z2, x1, x2, y1, y2, c1, c2.
+# the kernels return a (2, axes) array of averages and variances, in z, x, y, c order.
+#
+# ####
+
+# --------------------------------------------------------------------------------------------------
+def _variance_numpy(pts):
+    grouped = pts.reshape(pts.shape[0], -1, 2)
+
+    avgs = grouped.mean(axis=(0, 2))
+
+    # square the deviations directly rather than letting var() recompute the means
+    diff = grouped - avgs[:, np.newaxis]
+    return np.stack((avgs, (diff * diff).mean(axis=(0, 2))))
+
+# prefer the ahead-of-time build (see build_kernels.py), then a JIT build of the same kernel
+try:
+    from dl_kernels import variance
+except ImportError:
+    if numba is not None:
+        import build_kernels
+
+        variance = numba.njit(build_kernels.VARIANCE_SIG, fastmath=True, cache=True)(
+            build_kernels.variance
+        )
+    else:
+        variance = _variance_numpy
 
 
 # ##################################################################################################
@@ -49,25 +141,40 @@ def log(line):
 #
 # ####
 class BasicHandler(PrinterEventHandler):
-    def __init__(self, lock):
-        self.lock = lock
-        self.line = ""
+    def __init__(self):
+        # (kind, payload) per received line, consumed by the sendCommands thread
+        self.q = queue.Queue()
+        # one-shot signal, set once the printer reports online
+        self.online = threading.Event()
         self.error = False
 
     def on_init(self):
         debug('init')
 
     def on_send(self, command, gline):
-        debug('send {0}'.format(command))
+        debug('send {0}', command)
 
     def on_recv(self, line):
-        debug('recv {0}'.format(line))
-
-        self.last_line = line.strip()
+        s = line.strip()
         self.error = False
 
-        with self.lock:
-            self.lock.notify()
+        debug('recv {0}', s)
+
+        if s.startswith(CMD_COMPLETE):
+            self.q.put(('ok', ()))
+            return
+
+        if ACK_RE.fullmatch(s):
+            self.q.put(('ack', ()))
+            return
+
+        # M503 output may carry an 'echo:' prefix, so search rather than match
+        m = LINE_RE.search(s)
+        if m is None:
+            self.q.put(('recv', s))
+        else:
+            i = m.lastindex
+            self.q.put((m.lastgroup, tuple(float(v) for v in m.group(i + 1, i + 2, i + 3))))
 
     def on_connect(self):
         debug('connect')
@@ -76,24 +183,24 @@ class BasicHandler(PrinterEventHandler):
         debug('disconnect')
 
     def on_error(self, error):
-        debug('error {0}'.format(error))
+        err = str(error).strip()
+        debug('error {0}', err)
 
         self.error = True
-        self.last_line = line.strip()
 
-        with self.lock:
-            self.lock.notify()
+        self.q.put(('err', err))
 
     def on_online(self):
         debug('online')
 
         self.error = False
 
-        with self.lock:
-            self.lock.notify()
+        self.online.set()
 
     def on_temp(self, line):
-        debug('temp {0}'.format(line))
+        # only strip when the line is actually going to be printed
+        if DEBUG:
+            debug('temp {0}', line.strip())
 
 
 # ##################################################################################################
@@ -101,10 +208,9 @@ class BasicHandler(PrinterEventHandler):
 # Send the printhead to home position (G28)
 #
 # ####
-def go_home(printer, lock, handler):
+def go_home(printer, handler):
     printer.send_now('G28')
-    with lock:
-        lock.wait()
+    wait_ok(handler)
 
 
 # ##################################################################################################
@@ -112,26 +218,20 @@ def go_home(printer, lock, handler):
 # Perform the bend autoleveling function (G29)
 #
 # ####
-def run_autolevel(printer, lock, handler):
+def run_autolevel(printer, handler):
     printer.send_now('G29 P2 V4')
 
     results = []
 
-    # should get 13 outputs back
-    for x in range(0, 13):
-        with lock:
-            lock.wait()
-
-            m = re.search(CMD_COMPLETE_REGEX, handler.last_line)
-            if m:
-                return results
+    # should get 13 outputs back, the ack ends the read
+    while True:
+        kind, payload = next_reply(handler)
+        if kind in ACK_KINDS:
+            break
 
-            # response recieved, parse it
-            m = re.search(G29_REGEX, handler.last_line)
-            if m:
-                groups = m.groups()
-                if len(groups) == 3:
-                    results.append(float(groups[2]))
+        # response recieved, keep the Z reading
+        if kind == 'g29':
+            results.append(payload[2])
 
     return results
 
@@ -141,303 +241,231 @@ def run_autolevel(printer, lock, handler):
 # Heat the bed to the specified temperature in C (M140)
 #
 # ####
-def heat_bed(printer, lock, handler, temp):
-    printer.send_now('M190 S{0:.4f}'.format(temp))
-
-    heating = True
-    while heating:
-        with lock:
-            lock.wait()
-
-        m = re.search(CMD_COMPLETE_REGEX, handler.last_line)
-        if m:
-            heating = False
+def heat_bed(printer, handler, temp):
+    printer.send_now(f'M190 S{temp:.4f}')
+    wait_ok(handler)
 
 
 # --------------------------------------------------------------------------------------------------
 def computeVariance(data, status):
-    # get averages
-    x_total = 0.0
-    y_total = 0.0
-    z_total = 0.0
-    c_total = 0.0
-
-    dp_count = len(data['datapoints']) * 2.0
-
-    for d in data['datapoints']:
-        z_total += d['z1']
-        z_total += d['z2']
-        x_total += d['x1']
-        x_total += d['x2']
-        y_total += d['y1']
-        y_total += d['y2']
-        c_total += d['c1']
-        c_total += d['c2']
-
-    data['z_avg'] = z_total / dp_count
-    data['x_avg'] = x_total / dp_count
-    data['y_avg'] = y_total / dp_count
-    data['c_avg'] = c_total / dp_count
+    stats = data['stats']
+
+    out = variance(data['datapoints'])
+    stats[Stat.Z_AVG:Stat.C_AVG + 1] = out[0]
+    stats[Stat.Z_VAR:Stat.C_VAR + 1] = out[1]
 
     if status['ref_axis'] == None:
         log('setting ref_axis...')
 
-        status['ref_axis'] = 'z_avg'
-        if data['x_avg'] > data[status['ref_axis']]:
-            status['ref_axis'] = 'x_avg'
-        if data['y_avg'] > data[status['ref_axis']]:
-            status['ref_axis'] = 'y_avg'
-
-        log('ref_axis == {0}'.format(status['ref_axis']))
-
-    data['high_point'] = data[status['ref_axis']]
-    data['c_offset'] = data['c_avg'] - data['high_point']
-
-    # reset to compute square differences
-    x_total = 0.0
-    y_total = 0.0
-    z_total = 0.0
-    c_total = 0.0
-
-    for d in data['datapoints']:
-        z_total += pow(d['z1'] - data['z_avg'], 2)
-        z_total += pow(d['z2'] - data['z_avg'], 2)
-        x_total += pow(d['x1'] - data['x_avg'], 2)
-        x_total += pow(d['x2'] - data['x_avg'], 2)
-        y_total += pow(d['y1'] - data['y_avg'], 2)
-        y_total += pow(d['y2'] - data['y_avg'], 2)
-        c_total += pow(d['c1'] - data['c_avg'], 2)
-        c_total += pow(d['c2'] - data['c_avg'], 2)
-
-    data['z_var'] = z_total / dp_count
-    data['x_var'] = x_total / dp_count
-    data['y_var'] = y_total / dp_count
-    data['c_var'] = c_total / dp_count
+        # highest tower average, first one wins on ties
+        ref_axis = max((Stat.Z_AVG, Stat.X_AVG, Stat.Y_AVG), key=stats.__getitem__)
+        status['ref_axis'] = ref_axis
+
+        log(f'ref_axis == {ref_axis.name.lower()}')
+
+    high_point = float(stats[status['ref_axis']])
+    data['high_point'] = high_point
+    data['c_offset'] = float(stats[Stat.C_AVG]) - high_point
 
 # --------------------------------------------------------------------------------------------------
 def printReport(data, status):
-    log('Reference axis: {0}'.format(status['ref_axis']))
-    log('Z (avg: {0:.4f}, variance: {1:.6f})'.format(data['z_avg'], data['z_var']))
-    log('X (avg: {0:.4f}, variance: {1:.6f})'.format(data['x_avg'], data['x_var']))
-    log('Y (avg: {0:.4f}, variance: {1:.6f})'.format(data['y_avg'], data['y_var']))
-    log('C (avg: {0:.4f}, variance: {1:.6f})'.format(data['c_avg'], data['c_var']))
+    stats = data['stats']
+
+    log(f"Reference axis: {status['ref_axis'].name.lower()}")
+    log(f'Z (avg: {stats[Stat.Z_AVG]:.4f}, variance: {stats[Stat.Z_VAR]:.6f})')
+    log(f'X (avg: {stats[Stat.X_AVG]:.4f}, variance: {stats[Stat.X_VAR]:.6f})')
+    log(f'Y (avg: {stats[Stat.Y_AVG]:.4f}, variance: {stats[Stat.Y_VAR]:.6f})')
+    log(f'C (avg: {stats[Stat.C_AVG]:.4f}, variance: {stats[Stat.C_VAR]:.6f})')
 
 # --------------------------------------------------------------------------------------------------
-def runAdjustments(printer, lock, handler, data):
+def runAdjustments(printer, handler, data):
+    stats = data['stats']
+    high_point = data['high_point']
+    z_offset = high_point - stats[Stat.Z_AVG]
+    x_offset = high_point - stats[Stat.X_AVG]
+    y_offset = high_point - stats[Stat.Y_AVG]
+
     adjust_endstops = False
-    if abs(data['high_point'] - data['z_avg']) > TOLERANCE_MM:
-        log('z_offset too great: {0:.4f}'.format(data['high_point'] - data['z_avg']))
+    if abs(z_offset) > TOLERANCE_MM:
+        log(f'z_offset too great: {z_offset:.4f}')
         adjust_endstops = True
-    if abs(data['high_point'] - data['x_avg']) > TOLERANCE_MM:
-        log('x_offset too great: {0:.4f}'.format(data['high_point'] - data['x_avg']))
+    if abs(x_offset) > TOLERANCE_MM:
+        log(f'x_offset too great: {x_offset:.4f}')
         adjust_endstops = True
-    if abs(data['high_point'] - data['y_avg']) > TOLERANCE_MM:
-        log('y_offset too great: {0:.4f}'.format(data['high_point'] - data['y_avg']))
+    if abs(y_offset) > TOLERANCE_MM:
+        log(f'y_offset too great: {y_offset:.4f}')
         adjust_endstops = True
 
     if adjust_endstops:
-        adjustOffsets(printer, lock, handler, data)
+        adjustOffsets(printer, handler, data)
         return False
 
     if abs(data['c_offset']) > TOLERANCE_MM:
-        log('c_offset too great: {0:.4f}'.format(data['c_offset']))
-        adjustDeltaRadius(printer, lock, handler, data)
+        log(f"c_offset too great: {data['c_offset']:.4f}")
+        adjustDeltaRadius(printer, handler, data)
         return False
 
 
     return True
 
 # --------------------------------------------------------------------------------------------------
-def adjustOffsets(printer, lock, handler, data):
-    z_offset = data['z_avg'] - data['high_point']
-    x_offset = data['x_avg'] - data['high_point']
-    y_offset = data['y_avg'] - data['high_point']
+def adjustOffsets(printer, handler, data):
+    stats = data['stats']
+    high_point = data['high_point']
+    m666 = data['M666']
+
+    z = m666['Z'] + (stats[Stat.Z_AVG] - high_point)
+    x = m666['X'] + (stats[Stat.X_AVG] - high_point)
+    y = m666['Y'] + (stats[Stat.Y_AVG] - high_point)
 
-    printer.send_now('M666 Z{0:.4f} X{1:.4f} Y{2:.4f}'.format(
-        data['M666']['Z'] + z_offset,
-        data['M666']['X'] + x_offset,
-        data['M666']['Y'] + y_offset,
-    ))
+    printer.send_now(f'M666 Z{z:.4f} X{x:.4f} Y{y:.4f}')
 
-    with lock:
-        lock.wait()
+    wait_ok(handler)
 
 # --------------------------------------------------------------------------------------------------
-def adjustDeltaRadius(printer, lock, handler, data):
-    printer.send_now('M665 R{0:.4f}'.format(
-        (data['M665']['R'] - (data['c_offset']*2)),
-    ))
+def adjustDeltaRadius(printer, handler, data):
+    r = data['M665']['R'] - (data['c_offset']*2)
 
-    with lock:
-        lock.wait()
+    printer.send_now(f'M665 R{r:.4f}')
+
+    wait_ok(handler)
 
 # --------------------------------------------------------------------------------------------------
-def queryPrinter(printer, lock, handler, data):
+def queryPrinter(printer, handler, data):
     printer.send_now('M503')
 
     reading = True
     while reading:
-        with lock:
-            lock.wait()
-
-        m = re.search(CMD_COMPLETE_REGEX, handler.last_line)
-        if m:
+        kind, payload = next_reply(handler)
+        if kind in ACK_KINDS:
             reading = False
             continue
 
-        m = re.search(M666_REGEX, handler.last_line)
-        if m:
-            groups = m.groups()
+        if kind == 'm666':
+            x, y, z = payload
             data['M666'] = {}
-            data['M666']['X'] = float(groups[0])
-            data['M666']['Y'] = float(groups[1])
-            data['M666']['Z'] = float(groups[2])
+            data['M666']['X'] = x
+            data['M666']['Y'] = y
+            data['M666']['Z'] = z
             continue
 
-        m = re.search(M665_REGEX, handler.last_line)
-        if m:
-            groups = m.groups()
+        if kind == 'm665':
+            l, r, s = payload
             data['M665'] = {}
-            data['M665']['L'] = float(groups[0])
-            data['M665']['R'] = float(groups[1])
-            data['M665']['S'] = float(groups[2])
+            data['M665']['L'] = l
+            data['M665']['R'] = r
+            data['M665']['S'] = s
             continue
 
-    log('X {0:.4f}, Y {1:.4f}, Z {2:.4f}, L {3:.4f}, R {4:.4f}, S {5:.4f}'.format(
-            data['M666']['X'],
-            data['M666']['Y'],
-            data['M666']['Z'],
-            data['M665']['L'],
-            data['M665']['R'],
-            data['M665']['S'],
-    ))
+    m666 = data['M666']
+    m665 = data['M665']
+
+    log(f"X {m666['X']:.4f}, Y {m666['Y']:.4f}, Z {m666['Z']:.4f}, "
+        f"L {m665['L']:.4f}, R {m665['R']:.4f}, S {m665['S']:.4f}")
 
 # --------------------------------------------------------------------------------------------------
-def fixDeltaCalibration(printer, lock, handler, status):
-    go_home(printer, lock, handler)
-
-    for i in range(0, 3):
-        data = {
-            'datapoints' : [],
-            'high_point' : 0.0,
-            'c_offset'   : 0.0,
-            'z_avg'      : 0.0,
-            'z_var'      : 0.0,
-            'x_avg'      : 0.0,
-            'x_var'      : 0.0,
-            'y_avg'      : 0.0,
-            'y_var'      : 0.0,
-            'c_avg'      : 0.0,
-            'c_var'      : 0.0,
-        }
-
-        results = run_autolevel(printer, lock, handler)
+def fixDeltaCalibration(printer, handler, status, data):
+    go_home(printer, handler)
+
+    for i in range(0, AUTOLEVEL_RUNS):
+        results = run_autolevel(printer, handler)
         if len(results) == 8:
-            data['datapoints'].append({
-                'z1'    : results[0],
-                'z2'    : results[1],
-                'z_avg' : (results[0] + results[1]) / 2.0,
-                'x1'    : results[2],
-                'x2'    : results[3],
-                'x_avg' : (results[2] + results[3]) / 2.0,
-                'y1'    : results[4],
-                'y2'    : results[5],
-                'y_avg' : (results[4] + results[5]) / 2.0,
-                'c1'    : results[6],
-                'c2'    : results[7],
-                'c_avg' : (results[6] + results[7]) / 2.0,
-            })
+            data['datapoints'][i] = results
         else:
-            raise Exception('invalid result count from bed autolevel routine ({0}) :: {1}'.format(
-                len(results), 
-                results,
-            ))
+            raise Exception(
+                f'invalid result count from bed autolevel routine ({len(results)}) :: {results}'
+            )
 
     log('run complete. computing variance...')
     computeVariance(data, status)
     printReport(data, status)
 
     # done once all bed points are within the configured threshold of each other
-    queryPrinter(printer, lock, handler, data)
-    status['converged'] = runAdjustments(printer, lock, handler, data)
-
-    return data
+    queryPrinter(printer, handler, data)
+    status['converged'] = runAdjustments(printer, handler, data)
 
 # --------------------------------------------------------------------------------------------------
-def save_settings(printer, lock, handler):
+def save_settings(printer, handler):
     printer.send_now('M500')
 
-    with lock:
-        lock.wait()
+    wait_ok(handler)
 
 # --------------------------------------------------------------------------------------------------
-def set_defaults(printer, lock,  handler):
-    printer.send_now('M666 X0 Y0 Z0')
-    with lock:
-        lock.wait()
-
-    printer.send_now('M665 R{0:.4f}'.format(DEFAULT_DELTA_RADIUS))
-    with lock:
-        lock.wait()
-
-    printer.send_now('M206 Z0')
-    with lock:
-        lock.wait()
+def set_defaults(printer, handler):
+    cmds = [
+        'M666 X0 Y0 Z0',
+        f'M665 R{DEFAULT_DELTA_RADIUS:.4f}',
+        'M206 Z0',
+    ]
+
+    # queue everything up front, then collect one ack per command. with commands still in flight
+    # the acks report fewer free buffer slots, which on_recv queues as 'ack' rather than 'ok'
+    for cmd in cmds:
+        printer.send_now(cmd)
+
+    acks = 0
+    while acks < len(cmds):
+        kind, payload = next_reply(handler)
+        if kind in ACK_KINDS:
+            acks += 1
 
 # --------------------------------------------------------------------------------------------------
-def set_z_offset(printer, lock, handler, data):
-    hp = data['z_avg']
-    if data['x_avg'] > hp:
-        hp = data['x_avg']
-    if data['y_avg'] > hp:
-        hp = data['y_avg']
+def set_z_offset(printer, handler, data):
+    stats = data['stats']
+
+    hp = max(stats[Stat.Z_AVG], stats[Stat.X_AVG], stats[Stat.Y_AVG])
 
     zo = -(hp + Z_OFFSET)
 
-    log('Setting Z Offset to {0:.4f}'.format(zo))
+    log(f'Setting Z Offset to {zo:.4f}')
     
-    printer.send_now('M206 Z{0:.4f}'.format(zo))
-    with lock:
-        lock.wait()
+    printer.send_now(f'M206 Z{zo:.4f}')
+    wait_ok(handler)
 
 # --------------------------------------------------------------------------------------------------
-def sendCommands(printer, lock, handler):
+def sendCommands(printer, handler):
     # wait for the printer to come online
-    with lock:
-        lock.wait() # condition var appears to start off signaled? swallow the initial notify
-        lock.wait()
+    handler.online.wait()
+
+    # discard anything received while connecting so it isn't mistaken for a command reply
+    while not handler.q.empty():
+        handler.q.get_nowait()
 
     if RESET_DEFAULTS:
-        set_defaults(printer, lock, handler)
+        set_defaults(printer, handler)
 
     if PREHEAT_BED:
-        heat_bed(printer, lock, handler, BED_TEMP_C)
+        heat_bed(printer, handler, BED_TEMP_C)
 
     status = {
         'converged' : False,
         'ref_axis' : None,
     }
 
-    data = None
+    # buffers are shared across calibration passes, each pass overwrites them
+    data = {
+        'datapoints' : np.empty((AUTOLEVEL_RUNS, 8), dtype=np.float64),
+        'stats'      : np.zeros(len(Stat), dtype=np.float64),
+        'high_point' : 0.0,
+        'c_offset'   : 0.0,
+    }
 
     while not status['converged']:
-        data = fixDeltaCalibration(printer, lock, handler, status)
+        fixDeltaCalibration(printer, handler, status, data)
 
-    set_z_offset(printer, lock, handler, data)
-    save_settings(printer, lock, handler)
-    go_home(printer, lock, handler)
+    set_z_offset(printer, handler, data)
+    save_settings(printer, handler)
+    go_home(printer, handler)
 
 # entry point
 # --------------------------------------------------------------------------------------------------
 def main():
-    lock=threading.Condition()
-
-    handler=BasicHandler(lock)
+    handler=BasicHandler()
 
     printer=printcore()
     printer.addEventHandler(handler)
 
-    t = threading.Thread(target=sendCommands, args=(printer, lock, handler))
+    t = threading.Thread(target=sendCommands, args=(printer, handler))
     t.start()
 
     printer.connect(COM_PORT, 115200)
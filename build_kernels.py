@@ -0,0 +1,51 @@
+import numpy as np
+
+
+# ##################################################################################################
+#
+# Numeric kernels for DeltaLevel
+#
+# Run this file once (python build_kernels.py) to compile them ahead of time into the dl_kernels
+# extension module next to it. DeltaLevel uses dl_kernels when present and otherwise JIT compiles
+# the same functions with numba, or falls back to plain NumPy.
+#
+# ####
+VARIANCE_SIG = 'f8[:,:](f8[:,::1])'
+
+# --------------------------------------------------------------------------------------------------
+def variance(pts):
+    # pts columns are sample pairs per axis (z1, z2, x1, x2, ...); returns a (2, axes) array of
+    # averages and variances. single pass Welford per axis.
+    n_axes = pts.shape[1] // 2
+    out = np.empty((2, n_axes))
+
+    for a in range(n_axes):
+        count = 0
+        mean = 0.0
+        m2 = 0.0
+        for r in range(pts.shape[0]):
+            for c in range(a * 2, a * 2 + 2):
+                v = pts[r, c]
+                count += 1
+                delta = v - mean
+                mean += delta / count
+                m2 += (v - mean) * delta
+
+        out[0, a] = mean
+        out[1, a] = m2 / count
+
+    return out
+
+# --------------------------------------------------------------------------------------------------
+def build():
+    from numba.pycc import CC
+
+    cc = CC('dl_kernels')
+    cc.export('variance', VARIANCE_SIG)(variance)
+    cc.compile()
+
+
+# bootstrap
+# --------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    build()